@@ -3,50 +3,116 @@ import sys
 import logging
 from typing import List
 import math
-import json
+import orjson
 import traceback
 import os
+import time
+import tempfile
 import re
+import aiofiles
 import pandas as pd
-from fastapi.responses import StreamingResponse
-from urllib.parse import urlparse, urljoin
+import numpy as np
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from urllib.parse import urljoin
 import uvicorn
-import time
 import httpx
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict
 from dotenv import load_dotenv
-from playwright.sync_api import sync_playwright
 from decimal import Decimal
 from datetime import date, timedelta, datetime
 import calendar
 import importlib.util
+from functools import lru_cache
+from contextlib import suppress, asynccontextmanager
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import psycopg2
 from psycopg2.extras import execute_values, RealDictCursor
+from stagehand_pool import StagehandPool, WarmSession
+from scrape_utils import TranslateTable
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
 
-# Cargar variables de entorno
-load_dotenv()
+# Cargar variables de entorno desde rutas explícitas (.env del backend y luego el de
+# la raíz del proyecto) en lugar de buscar el archivo recorriendo directorios padre
+for _env_path in (os.path.join(BACKEND_DIR, ".env"), os.path.join(os.path.dirname(BACKEND_DIR), ".env")):
+    load_dotenv(_env_path)
 
 try:
     from stagehand import Stagehand
 except ImportError:
     Stagehand = None
 
-if sys.platform == 'win32':
-    asyncio.set_event_loop_policy(asyncio.WindowsProactorEventLoopPolicy())
+# Loop de eventos basado en libuv: winloop en Windows, uvloop en Linux/Mac.
+# Si no está instalado, Windows vuelve al Proactor (necesario para los subprocesos
+# del navegador) y el resto queda con el loop estándar de asyncio.
+try:
+    if sys.platform == 'win32':
+        import winloop as _fast_loop
+    else:
+        import uvloop as _fast_loop
+except ImportError:
+    _fast_loop = None
+    if sys.platform == 'win32':
+        asyncio.set_event_loop_policy(asyncio.WindowsProactorEventLoopPolicy())
+else:
+    _fast_loop.install()
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app):
+    """Arranque y cierre del proceso.
+
+    Al arrancar crea el directorio de datos, migra el historial anterior si existe y
+    lanza el volcado periódico del historial. Al cerrar detiene ese volcado, escribe
+    lo pendiente y libera el executor de scraping y los navegadores del pool.
+    """
+    os.makedirs(DATA_DIR, exist_ok=True)
+    migrate_legacy_history()
+    history_flush_task = asyncio.create_task(history_flush_loop())
+    try:
+        yield
+    finally:
+        history_flush_task.cancel()
+        # Se espera a que la tarea termine de cancelarse antes del volcado final
+        with suppress(asyncio.CancelledError):
+            await history_flush_task
+        try:
+            await flush_history()
+        finally:
+            SCRAPE_EXECUTOR.shutdown(wait=False, cancel_futures=True)
+            STAGEHAND_POOL.close_all()
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+
+# Cualquier origen y sin credenciales: la API no usa cookies (la API key viaja en el
+# cuerpo) y así el middleware responde con "*" sin comparar el origen en cada request
+app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_credentials=False, allow_methods=["*"], allow_headers=["*"])
 
-frontend_port = os.getenv("FRONTEND_PORT", "8501")
-origins = [f"http://localhost:{frontend_port}", f"http://127.0.0.1:{frontend_port}", "*"]
-app.add_middleware(CORSMiddleware, allow_origins=origins, allow_credentials=True, allow_methods=["*"], allow_headers=["*"])
+# Rutas fijas durante toda la vida del proceso: se resuelven una sola vez
+DATA_DIR = os.path.abspath("data")
+DATA_FILE = os.path.join(DATA_DIR, "publicaciones.jsonl")
+# Formato anterior (un único array JSON reescrito en cada request); se migra al arrancar
+LEGACY_DATA_FILE = os.path.join(DATA_DIR, "publicaciones.json")
+MAP_FILE = os.path.join(DATA_DIR, "navigation_map.json")
 
-DATA_FILE = os.path.abspath(os.path.join("data", "publicaciones.json"))
-MAP_FILE = os.path.abspath(os.path.join("data", "navigation_map.json"))
+# km y año entran holgados en 32 bits; los precios quedan en float64 porque
+# en ARS superan el rango entero exacto de float32.
+NUMERIC_DTYPES = {"year": "int32", "km": "int32"}
+# Fuera de este rango el downcast a int32 da la vuelta en silencio (un km basura de la
+# IA quedaría negativo y pasaría el filtro de km máximo)
+INT32_RANGE = (np.iinfo(np.int32).min, np.iinfo(np.int32).max)
+
+# Escritura diferida del historial: los requests encolan sus publicaciones y una
+# tarea de fondo las vuelca juntas cada HISTORY_FLUSH_INTERVAL_S segundos.
+HISTORY_FLUSH_INTERVAL_S = 2.0
+HISTORY_READ_CHUNK = 64 * 1024
+_history_lock = asyncio.Lock()
+_pending_history = []
 
 SITE_URLS = {
     "kavak": "https://www.kavak.com/ar",
@@ -54,6 +120,9 @@ SITE_URLS = {
 }
 
 class ScrapeRequest(BaseModel):
+    # Inmutable (se comparte entre los hilos de cada sitio) y estricto con campos desconocidos
+    model_config = ConfigDict(frozen=True, extra='forbid')
+
     sites: List[str]
     brand: str
     model: str
@@ -69,6 +138,102 @@ class ScrapeRequest(BaseModel):
     patente: str = None
     headless: bool = False
 
+def migrate_legacy_history():
+    """Convierte el historial publicaciones.json (array) a JSON Lines, una sola vez.
+
+    Las filas migradas quedan antes de las que ya hubiera en el JSONL. El archivo viejo
+    se reclama primero con un rename atómico: con varios workers sólo uno lo migra, y
+    si el proceso muere a mitad de camino no se vuelve a migrar (no duplica filas);
+    queda como .migrating-<pid> para recuperarlo a mano.
+    """
+    claimed_file = f"{LEGACY_DATA_FILE}.migrating-{os.getpid()}"
+    try:
+        os.rename(LEGACY_DATA_FILE, claimed_file)
+    except FileNotFoundError:
+        return
+    try:
+        with open(claimed_file, "rb") as f:
+            legacy_rows = orjson.loads(f.read()) or []
+    except (OSError, orjson.JSONDecodeError) as e:
+        logger.error(f"❌ No se pudo leer el historial anterior {claimed_file}: {e}")
+        return
+
+    fd, tmp_file = tempfile.mkstemp(dir=DATA_DIR, prefix="publicaciones-", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as out:
+            out.write(b"".join(orjson.dumps(r) + b"\n" for r in legacy_rows))
+            try:
+                with open(DATA_FILE, "rb") as current:
+                    out.write(current.read())
+            except FileNotFoundError:
+                pass
+        os.replace(tmp_file, DATA_FILE)
+    except BaseException:
+        os.unlink(tmp_file)
+        raise
+    os.replace(claimed_file, LEGACY_DATA_FILE + ".migrated")
+    logger.info(f"📦 Historial anterior migrado a JSON Lines ({len(legacy_rows)} publicaciones).")
+
+async def queue_history(records):
+    """Encola publicaciones para el próximo volcado al historial JSONL."""
+    async with _history_lock:
+        _pending_history.extend(records)
+
+async def flush_history():
+    """Escribe en una sola operación todo lo pendiente (serializado por el lock).
+
+    Lo pendiente se descarta recién cuando la escritura terminó bien: si falla
+    (disco lleno, permisos, un valor no serializable) se reintenta en el próximo ciclo.
+    """
+    async with _history_lock:
+        if not _pending_history:
+            return
+        batch = b"".join(
+            orjson.dumps(r, default=json_serial, option=orjson.OPT_APPEND_NEWLINE | orjson.OPT_SERIALIZE_NUMPY)
+            for r in _pending_history
+        )
+        async with aiofiles.open(DATA_FILE, "ab") as f:
+            await f.write(batch)
+        _pending_history.clear()
+
+async def history_flush_loop():
+    while True:
+        await asyncio.sleep(HISTORY_FLUSH_INTERVAL_S)
+        try:
+            await flush_history()
+        except Exception as e:
+            logger.error(f"❌ Error escribiendo historial de publicaciones: {e}")
+
+def create_stagehand_client(api_key, headless):
+    # La API key viaja en la configuración del cliente, no en variables de entorno del proceso
+    return Stagehand(
+        server="local",
+        model_api_key=api_key,
+        local_headless=headless,
+        local_ready_timeout_s=20.0,
+        timeout=600.0
+    )
+
+MODEL_NAME = "google/gemini-2.5-flash"  # Modelo optimizado para tareas de navegación y extracción con contexto amplio
+#MODEL_NAME = "google/gemini-3-flash-preview"
+
+def create_warm_session(api_key, headless, site_name=None):
+    # site_name sólo forma parte de la clave del pool: cada sitio conserva su propia sesión
+    return WarmSession(create_stagehand_client(api_key, headless), MODEL_NAME, headless)
+
+# Sesiones Stagehand (cliente + navegador abierto) reutilizables entre requests.
+# La clave incluye el sitio, así que el tamaño por defecto cubre a todos los sitios soportados
+STAGEHAND_POOL_SIZE = int(os.getenv("STAGEHAND_POOL_SIZE", str(len(SITE_URLS))))
+STAGEHAND_POOL = StagehandPool(create_warm_session, max_size=STAGEHAND_POOL_SIZE)
+
+# Hilos dedicados al scraping, acotados a la cantidad de navegadores simultáneos: los
+# sitios que excedan el límite esperan en la cola del executor (sin ocupar hilos del
+# executor por defecto, que comparten el resto de las llamadas bloqueantes)
+SCRAPE_EXECUTOR = ThreadPoolExecutor(
+    max_workers=int(os.getenv("SCRAPE_CONCURRENCY", STAGEHAND_POOL_SIZE)),
+    thread_name_prefix="stagehand"
+)
+
 def get_db_connection():
     return psycopg2.connect(
         host=os.getenv("DB_HOST", "localhost"),
@@ -120,7 +285,7 @@ async def get_exchange_rate():
             if response.status_code == 200:
                 data = response.json()
                 # Guardamos todos los tipos de dólar recibidos para historial
-                save_dollars_to_db(data)
+                await asyncio.to_thread(save_dollars_to_db, data)
                 
                 oficial = next((d for d in data if d.get('casa') == 'oficial'), None)
                 if oficial:
@@ -128,13 +293,44 @@ async def get_exchange_rate():
         raise Exception("Falla en la respuesta de la API")
     except Exception as e:
         logger.error(f"⚠️ Error API Dólar: {e}. Buscando respaldo en DB...")
-        valor_db = get_latest_dollar_from_db()
+        valor_db = await asyncio.to_thread(get_latest_dollar_from_db)
         if valor_db: return valor_db
         logger.error("🚨 Sin respaldo de dólar. Usando 1.0 como fallback.")
         return 1.0
 
-def save_to_db(extracted_data, site_averages, request_data, progress_callback=None):
-    """Persiste los datos en PostgreSQL: tabla transaccional y tabla de resultados."""
+def save_extractions(extracted_data):
+    """Guarda las publicaciones extraídas en la tabla transaccional extractions (True si se guardaron)."""
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor()
+        insert_query = """
+            INSERT INTO extractions (brand, model, version, year, km, price, currency, title, combustible, transmision, zona, fecha_publicacion, reservado, url, site, datos_adicionales)
+            VALUES %s
+        """
+        values = [
+            (
+                item.get('brand'), item.get('model'), item.get('version'), item.get('year'), item.get('km'), 
+                item.get('price'), item.get('currency'), item.get('title'), item.get('combustible'), 
+                item.get('transmision'), item.get('zona'), item.get('fecha_publicacion'), 
+                item.get('reservado'), item.get('url'), item.get('site'),
+                orjson.dumps(item.get('custom_data', {})).decode()
+            ) for item in extracted_data
+        ]
+        execute_values(cur, insert_query, values)
+        conn.commit()
+        cur.close()
+        conn.close()
+        return True
+    except Exception as e:
+        logger.error(f"❌ Error guardando extracciones en DB: {e}")
+        logger.error(traceback.format_exc())
+        return False
+
+def save_to_db(site_averages, request_data, progress_callback=None):
+    """Calcula y persiste la valuación en PostgreSQL (tabla de resultados).
+
+    Las publicaciones de cada scraping se guardan aparte, una sola vez, con save_extractions.
+    """
     updated_stock = []
     try:
         conn = get_db_connection()
@@ -154,23 +350,6 @@ def save_to_db(extracted_data, site_averages, request_data, progress_callback=No
         else:
             precio_propuesto_base = meli_avg if meli_avg > 0 else kavak_avg
 
-        # 1. Tabla Transaccional: extractions
-        if extracted_data:
-            insert_query = """
-                INSERT INTO extractions (brand, model, version, year, km, price, currency, title, combustible, transmision, zona, fecha_publicacion, reservado, url, site, datos_adicionales)
-                VALUES %s
-            """
-            values = [
-                (
-                    item.get('brand'), item.get('model'), item.get('version'), item.get('year'), item.get('km'), 
-                    item.get('price'), item.get('currency'), item.get('title'), item.get('combustible'), 
-                    item.get('transmision'), item.get('zona'), item.get('fecha_publicacion'), 
-                    item.get('reservado'), item.get('url'), item.get('site'),
-                    json.dumps(item.get('custom_data', {}))
-                ) for item in extracted_data
-            ]
-            execute_values(cur, insert_query, values)
-
         # 2. Tabla de Resultados: PreciosAutosUsados
         if request_data.patente:
             # Obtener datos de stock_usados como referencia
@@ -344,37 +523,139 @@ def save_to_db(extracted_data, site_averages, request_data, progress_callback=No
         logger.error(traceback.format_exc())
         return []
 
+@lru_cache(maxsize=None)
 def load_scraper_module(file_name):
-    """Carga dinámicamente un módulo de scraping desde un archivo."""
-    path = os.path.join(os.path.dirname(__file__), file_name)
+    """Carga dinámicamente un módulo de scraping desde un archivo (una sola vez por proceso)."""
+    path = os.path.join(BACKEND_DIR, file_name)
     spec = importlib.util.spec_from_file_location(file_name.replace(" ", "_"), path)
     module = importlib.util.module_from_spec(spec)
     spec.loader.exec_module(module)
     return module
 
-def get_full_navigation_instruction(domain: str, brand: str, model: str, year: int, version: str, custom_template: str = None) -> str:
-    """
-    Genera la instrucción completa y robusta para el agente de IA.
+# Sinónimos con los que la IA puede devolver cada campo estándar
+PRICE_KEYS = ('precio', 'price', 'precio_contado')
+CURRENCY_KEYS = ('moneda', 'currency')
+KM_KEYS = ('km', 'kilometraje')
+YEAR_KEYS = ('año', 'year')
+BRAND_KEYS = ('marca', 'brand')
+MODEL_KEYS = ('modelo', 'model')
+LINK_KEYS = ('link', 'url')
+RESERVED_KEYS = ('reservado',)
+
+# Campos de texto con default fijo: (campo normalizado, sinónimos en la respuesta de la IA, default)
+TEXT_FIELDS = (
+    ("version", ('version',), 'N/A'),
+    ("title", ('titulo', 'title'), 'N/A'),
+    ("combustible", ('combustible',), 'N/A'),
+    ("transmision", ('transmision',), 'N/A'),
+    ("zona", ('zona', 'ubicacion'), 'N/A'),
+    ("fecha_publicacion", ('fecha_publicacion',), 'N/A'),
+)
+
+# Campos que ya son parte del esquema estándar (incluyendo sinónimos)
+STANDARD_KEYS = frozenset(
+    PRICE_KEYS + CURRENCY_KEYS + KM_KEYS + YEAR_KEYS + BRAND_KEYS + MODEL_KEYS + LINK_KEYS + RESERVED_KEYS
+    + tuple(key for _, keys, _ in TEXT_FIELDS for key in keys)
+)
+
+# Para str.translate: deja dígitos y '.', pasa ',' a '.' y borra el resto
+_NUMERIC_TABLE = TranslateTable({ord(c): c for c in '0123456789.'})
+_NUMERIC_TABLE[ord(',')] = '.'
+# Punto seguido de exactamente 3 dígitos: separador de miles ("1.500.000" / "25.000")
+_THOUSANDS_DOT = re.compile(r'\.(?=\d{3}(?:\.|$))')
+
+def _coalesce(df, keys, default):
+    """Primer valor no nulo entre columnas sinónimas (ej: 'precio' / 'price'), o el default."""
+    result = None
+    for key in keys:
+        if key in df.columns:
+            result = df[key] if result is None else result.combine_first(df[key])
+    if result is None:
+        return pd.Series(default, index=df.index, dtype=object)
+    return result.fillna(default)
+
+def _to_number(series):
+    """Limpia y convierte una columna completa a float (0.0 si no es numérica)."""
+    cleaned = series.astype(str).str.translate(_NUMERIC_TABLE).str.replace(_THOUSANDS_DOT, '', regex=True)
+    return pd.to_numeric(cleaned, errors='coerce').fillna(0.0)
+
+def normalize_site_items(items, site_name, request, exchange_rate):
+    """Normaliza en bloque (columnas vectorizadas) las publicaciones extraídas de un sitio.
+
+    Devuelve la lista de registros normalizados (vacía si no hubo publicaciones válidas).
     """
-    if custom_template:
-        # Reemplazar variables en el template del usuario
-        return custom_template.format(marca=brand, modelo=model, anio=year, version=version)
+    items = [item for item in items if isinstance(item, dict)]
+    if not items:
+        return []
+    raw = pd.DataFrame(items)
 
-    base_instr = ""
-    
-    if "kavak" in domain:
-        return base_instr + (
-            "1. Si aparece un cartel de cookies o selección de país/región, acéptalo o ciérralo.\n"
-            "2. Asegúrate de estar en la sección de compra de autos o categoria de Vehiculos (Marketplace). Si estás en la home, busca el botón 'Comprar un auto', Categoria 'Vehiculos' o similar.\n"
-            "3. Verificar si se observan los filtros de búsqueda, en caso de que no se hallen hacer clic en la barra de búsqueda (entry point) para ver filtros si corresponde CASO CONTRARIO NO HACER NADA.\n"
-            "REGLA CRÍTICA: Si no encuentras el valor exacto solicitado para CUALQUIERA de los filtros (Marca, Modelo, etc.), DETÉN el proceso inmediatamente. No intentes seleccionar valores similares ni continúes con el resto de los pasos.\n"
-            f"4. Aplica los filtros: Marca (puede tener otros nombres considerar todas las variantes posibles): '{brand}', Modelo (puede tener otros nombres considerar todas las variantes posibles): '{model}', Año (puede tener otros nombres considerar todas las variantes posibles): '{year}' y Disponibilidad de auto (puede tener otros nombres considerar todas las variantes posibles): 'Disponible' (o similar). Los filtros pueden aparecer como botones, enlaces o listas desplegables. Busca específicamente el botón o enlace con el texto '{year}'. Si no lo ves, expande la sección correspondiente o busca un botón de 'Ver más'.\n"
-            "6. Ordenar las publicaciones por 'Relevancia'.\n"
-            "7. Haz scroll para cargar los resultados."
-        )
-    elif "mercadolibre" in domain:
-        return base_instr + (
-                f"""OBJETIVO: Encontrar un vehículo {brand} {model} usado del año {year}, evitando accesorios o repuestos.
+    price = _to_number(_coalesce(raw, PRICE_KEYS, 0))
+    currency = _coalesce(raw, CURRENCY_KEYS, 'ARS').astype(str).str.upper()
+    km = _to_number(_coalesce(raw, KM_KEYS, 0))
+    year = _to_number(_coalesce(raw, YEAR_KEYS, request.year))
+    # Publicaciones con km/año fuera de int32: valores basura, se descartan
+    in_range = (km.between(*INT32_RANGE) & year.between(*INT32_RANGE)).to_numpy()
+    km = km.where(in_range, 0).astype('int64')
+    year = year.where(in_range, 0).astype('int64')
+    base_url = SITE_URLS.get(site_name, "")
+    links = _coalesce(raw, LINK_KEYS, '').astype(str)
+
+    # Guardar en custom_data SOLO los campos que el usuario solicitó explícitamente
+    # y que no colisionan con los campos estándar ya procesados.
+    custom_keys = set(request.custom_fields) - STANDARD_KEYS
+
+    text = {
+        name: _coalesce(raw, keys, default).astype(str)
+        for name, keys, default in TEXT_FIELDS
+    }
+    df = pd.DataFrame({
+        "brand": _coalesce(raw, BRAND_KEYS, request.brand).astype(str),
+        "model": _coalesce(raw, MODEL_KEYS, request.model).astype(str),
+        "year": year, "km": km, "price": price, "currency": currency,
+        "price_ars": price.where(currency != 'USD', price * exchange_rate),
+        # Columnas de texto: TEXT_FIELDS es la única definición
+        **text,
+        "reservado": _coalesce(raw, RESERVED_KEYS, False).astype(bool),
+        "custom_data": [{k: v for k, v in item.items() if k in custom_keys} for item in items],
+        "url": [urljoin(base_url, link) for link in links],
+        "site": site_name.capitalize()
+    }, index=raw.index)[in_range].astype(NUMERIC_DTYPES)
+
+    # Filtro de kilometraje máximo solicitado (0 = sin límite)
+    if request.km_max > 0:
+        # Máscara booleana directa sobre el array de numpy (sin Series intermedia)
+        df = df[df['km'].to_numpy() <= request.km_max]
+    return df.to_dict('records') if len(df) else []
+
+def price_totals(records):
+    """Suma y cantidad de los precios en ARS válidos (> 0 y finitos) de las publicaciones."""
+    total, count = 0.0, 0
+    for r in records:
+        price = r['price_ars']
+        if price > 0 and math.isfinite(price):
+            total += price
+            count += 1
+    return total, count
+
+def average_of(total, count):
+    return total / count if count else 0.0
+
+# Esquemas fijos de las extracciones de control (se construyen una sola vez por proceso)
+RESULTS_CHECK_SCHEMA = {"type": "object", "properties": {"has_results": {"type": "boolean"}}}
+CURRENT_URL_SCHEMA = {"type": "object", "properties": {"url": {"type": "string", "format": "uri"}}}
+
+# Instrucciones de navegación por sitio: plantillas fijas, por request sólo se sustituyen
+# marca/modelo/año con str.format
+KAVAK_NAV_TEMPLATE = (
+    "1. Si aparece un cartel de cookies o selección de país/región, acéptalo o ciérralo.\n"
+    "2. Asegúrate de estar en la sección de compra de autos o categoria de Vehiculos (Marketplace). Si estás en la home, busca el botón 'Comprar un auto', Categoria 'Vehiculos' o similar.\n"
+    "3. Verificar si se observan los filtros de búsqueda, en caso de que no se hallen hacer clic en la barra de búsqueda (entry point) para ver filtros si corresponde CASO CONTRARIO NO HACER NADA.\n"
+    "REGLA CRÍTICA: Si no encuentras el valor exacto solicitado para CUALQUIERA de los filtros (Marca, Modelo, etc.), DETÉN el proceso inmediatamente. No intentes seleccionar valores similares ni continúes con el resto de los pasos.\n"
+    "4. Aplica los filtros: Marca (puede tener otros nombres considerar todas las variantes posibles): '{brand}', Modelo (puede tener otros nombres considerar todas las variantes posibles): '{model}', Año (puede tener otros nombres considerar todas las variantes posibles): '{year}' y Disponibilidad de auto (puede tener otros nombres considerar todas las variantes posibles): 'Disponible' (o similar). Los filtros pueden aparecer como botones, enlaces o listas desplegables. Busca específicamente el botón o enlace con el texto '{year}'. Si no lo ves, expande la sección correspondiente o busca un botón de 'Ver más'.\n"
+    "6. Ordenar las publicaciones por 'Relevancia'.\n"
+    "7. Haz scroll para cargar los resultados."
+)
+MELI_NAV_TEMPLATE = """OBJETIVO: Encontrar un vehículo {brand} {model} usado del año {year}, evitando accesorios o repuestos.
 
                 PASOS:
                 1. BÚSQUEDA INICIAL: Localiza el buscador principal en la parte superior (header) y escribe '{brand} {model}'. Presiona Enter o haz clic en la lupa para buscar.
@@ -388,13 +669,38 @@ def get_full_navigation_instruction(domain: str, brand: str, model: str, year: i
                 4. VERIFICACIÓN FINAL: 
                 - Si aparece un mensaje de 'No hay publicaciones que coincidan', informa 'Sin stock'.
                 - Si hay resultados, realiza un scroll suave para asegurar que se carguen las unidades y confirma que el catálogo sea de vehículos reales.
-                """      )
+                """
+DEFAULT_NAV_TEMPLATE = "4. Busca y filtra por Marca '{brand}', Modelo '{model}' y Año '{year}'.\n5. Haz scroll para cargar resultados."
+
+@lru_cache(maxsize=256)
+def get_full_navigation_instruction(domain: str, brand: str, model: str, year: int, version: str, custom_template: str = None) -> str:
+    """
+    Genera la instrucción completa y robusta para el agente de IA.
+    """
+    if custom_template:
+        # Reemplazar variables en el template del usuario
+        return custom_template.format(marca=brand, modelo=model, anio=year, version=version)
+
+    if "kavak" in domain:
+        template = KAVAK_NAV_TEMPLATE
+    elif "mercadolibre" in domain:
+        template = MELI_NAV_TEMPLATE
     else:
-        return base_instr + f"4. Busca y filtra por Marca '{brand}', Modelo '{model}' y Año '{year}'.\n5. Haz scroll para cargar resultados."
+        template = DEFAULT_NAV_TEMPLATE
+    return template.format(brand=brand, model=model, year=year)
+
+@lru_cache(maxsize=256)
+def get_results_check_instruction(brand: str, model: str, year: int) -> str:
+    """Instrucción para verificar que los filtros se aplicaron (memoizada por búsqueda)."""
+    return (
+        f"Analiza la página actual. ¿Se aplicaron correctamente los filtros de Marca (puede tener otros nombres considerar todas las variantes posibles): '{brand}', Modelo  (puede tener otros nombres considerar todas las variantes posibles): '{model}' y Año  (puede tener otros nombres considerar todas las variantes posibles): '{year}'? "
+        "¿La página muestra resultados que coinciden con estos filtros, o muestra un mensaje de '0 resultados' o 'No se encontraron vehículos'? "
+        "Responde false si los filtros no se aplicaron correctamente o si no hay resultados que coincidan con la búsqueda."
+    )
 
 @app.get("/stock")
-async def get_stock():
-    """Obtiene la lista de vehículos en stock."""
+def get_stock():
+    """Obtiene la lista de vehículos en stock (def: FastAPI la corre en el threadpool, psycopg2 es bloqueante)."""
     try:
         conn = get_db_connection()
         cur = conn.cursor(cursor_factory=RealDictCursor)
@@ -411,6 +717,222 @@ async def get_stock():
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+def json_serial(obj):
+    """Serializa tipos que orjson no cubre de forma nativa (Decimal de la base de datos)."""
+    if isinstance(obj, Decimal):
+        val = float(obj)
+        return val if math.isfinite(val) else 0.0
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError(f"Type {type(obj)} not serializable")
+
+def ndjson_line(event):
+    """Codifica un evento del stream como una línea JSON (bytes) con orjson.
+
+    datetime/date y los escalares de numpy los resuelve orjson en C; el resto pasa por json_serial.
+    """
+    return orjson.dumps(event, default=json_serial, option=orjson.OPT_APPEND_NEWLINE | orjson.OPT_SERIALIZE_NUMPY)
+
+class SharedScrape:
+    """Scraping de un sitio en curso, compartido por todos los requests idénticos.
+
+    El progreso y los errores (con su captura) se reenvían a la cola de cada request
+    suscripto. Las publicaciones se persisten una sola vez al terminar el scraping
+    (persist_shared_scrape), sin depender de que algún stream siga abierto.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.queues = []
+        self.future = None
+
+    def publish(self, event):
+        # Se invoca desde el hilo del scraping: copia de la lista y envío seguro entre hilos
+        for queue in list(self.queues):
+            self.loop.call_soon_threadsafe(queue.put_nowait, event)
+
+    def log_status(self, msg):
+        logger.info(msg)
+        self.publish({"type": "status", "message": msg})
+
+    def send_error(self, msg, screenshot=None):
+        logger.error(f"❌ {msg}")
+        self.publish({"type": "error", "message": msg, "screenshot": screenshot})
+
+# Scrapings por sitio en curso: los requests idénticos que llegan mientras tanto se suman
+# al mismo resultado en lugar de abrir otro navegador y repetir las llamadas al LLM
+_INFLIGHT_SCRAPES = {}
+
+# Resultados recientes por sitio (misma clave, LRU con TTL): un request repetido dentro
+# del TTL no vuelve a scrapear. El filtro de km se aplica después, al normalizar, y las
+# publicaciones servidas desde acá no se vuelven a persistir (ya las guardó quien scrapeó).
+SITE_RESULT_TTL_S = float(os.getenv("SITE_RESULT_TTL_S", "300"))
+SITE_RESULT_CACHE_SIZE = 128
+_site_result_cache = OrderedDict()
+
+def get_cached_site_result(key):
+    entry = _site_result_cache.get(key)
+    if entry is None:
+        return None
+    stored_at, result = entry
+    if time.monotonic() - stored_at > SITE_RESULT_TTL_S:
+        del _site_result_cache[key]
+        return None
+    _site_result_cache.move_to_end(key)
+    return result
+
+def store_site_result(key, result):
+    _site_result_cache[key] = (time.monotonic(), result)
+    _site_result_cache.move_to_end(key)
+    if len(_site_result_cache) > SITE_RESULT_CACHE_SIZE:
+        # Se descarta el usado hace más tiempo
+        _site_result_cache.popitem(last=False)
+
+# Tareas de persistencia en curso (el loop sólo guarda referencias débiles a las tareas)
+_persist_tasks = set()
+
+async def persist_shared_scrape(key, shared, request, site_name, exchange_task):
+    """Persiste una sola vez el resultado de un scraping compartido y lo deja en caché.
+
+    Corre como tarea propia, así que no depende de que el request que lo inició (ni
+    ningún otro) siga conectado. Sólo los resultados con publicaciones ya guardadas
+    entran en la caché: los módulos de cada sitio absorben sus errores por publicación
+    y devuelven la lista vacía, que puede ser un fallo transitorio.
+    """
+    try:
+        result = await shared.future
+        if not isinstance(result, dict) or not result.get("autos"):
+            return
+        exchange_rate = await exchange_task
+        records = normalize_site_items(result["autos"], site_name, request, exchange_rate)
+        if records:
+            # JSON Lines append-only: sólo se encolan las publicaciones nuevas
+            await queue_history(records)
+            if not await asyncio.to_thread(save_extractions, records):
+                return
+        store_site_result(key, result)
+    except Exception as e:
+        logger.error(f"❌ Error persistiendo resultados de {site_name}: {e}")
+    finally:
+        _INFLIGHT_SCRAPES.pop(key, None)
+
+def start_shared_scrape(loop, key, request, site_name, exchange_task):
+    """Lanza el scraping de un sitio en el executor y su persistencia al terminar."""
+    shared = SharedScrape(loop)
+    shared.future = loop.run_in_executor(SCRAPE_EXECUTOR, run_site_scraping, request, site_name, SITE_URLS[site_name], shared.log_status, shared.send_error)
+    _INFLIGHT_SCRAPES[key] = shared
+    persist_task = loop.create_task(persist_shared_scrape(key, shared, request, site_name, exchange_task))
+    _persist_tasks.add(persist_task)
+    persist_task.add_done_callback(_persist_tasks.discard)
+    return shared
+
+def site_scrape_key(request, site_name):
+    """Clave de los parámetros que determinan el resultado del scraping de un sitio."""
+    return (
+        site_name, request.api_key, request.headless,
+        request.brand, request.model, request.year, request.version,
+        request.nav_instr_kavak, request.ext_instr_kavak,
+        request.nav_instr_meli, request.ext_instr_meli,
+        tuple(request.custom_fields)
+    )
+
+def run_site_scraping(request, site_name, target_url, progress_callback, error_callback):
+    """Scrapea un sitio en un hilo de trabajo con una sesión del pool (navegador ya abierto)."""
+    # --- NAVEGACIÓN ASISTIDA POR IA (Stagehand) ---
+    progress_callback(f"🌐 [{site_name.upper()}] Iniciando Agente...")
+    # Sesión por sitio: vuelve al mismo dominio con cookies/consentimientos ya aceptados.
+    # El pool acota el total de navegadores entre todas las claves y, si está lleno,
+    # cierra el ocioso menos reciente de otra clave (con el tamaño por defecto entra
+    # una sesión por cada sitio soportado)
+    with STAGEHAND_POOL.lease((request.api_key, request.headless, site_name)) as warm:
+        result = scrape_site_session(warm.client, warm.session_id, request, site_name, target_url, progress_callback, error_callback)
+        # Fallos del agente seguidos: la sesión se recicla al devolverla al pool
+        warm.record_result(result != "ERROR")
+        return result
+
+def scrape_site_session(client_sync, sess_id, request, site_name, target_url, progress_callback, error_callback):
+    domain = site_name
+    client_sync.sessions.navigate(id=sess_id, url=target_url)
+
+    # Seleccionar instrucción según el sitio
+    site_nav_instr = request.nav_instr_kavak if "kavak" in site_name else request.nav_instr_meli
+    site_ext_instr = request.ext_instr_kavak if "kavak" in site_name else request.ext_instr_meli
+
+    # Formatear instrucciones de extracción si contienen variables dinámicas
+    if site_ext_instr:
+        try:
+            site_ext_instr = site_ext_instr.format(
+                marca=request.brand, modelo=request.model, 
+                anio=request.year, version=request.version
+            )
+        except: pass
+
+    instruction = get_full_navigation_instruction(domain, request.brand, request.model, request.year, request.version, site_nav_instr)
+
+    try:
+        progress_callback(f"🤖 [{site_name.upper()}] Agente IA navegando...")
+        client_sync.sessions.execute(
+            id=sess_id,
+            execute_options={
+                "instruction": instruction,
+                "max_steps": 20,
+            },
+            agent_config={"model": {"model_name": MODEL_NAME}},
+        )
+    except Exception as e:
+        screenshot = None
+        try:
+            ss = client_sync.sessions.screenshot(id=sess_id)
+            screenshot = ss.data.base64
+        except: pass
+        error_callback(f"Error en {site_name}: {str(e)}", screenshot)
+        return "ERROR"
+
+    # Verificación rápida de resultados para detener el proceso si no hay nada
+    progress_callback(f"🧐 [{site_name.upper()}] Verificando resultados...")
+    check_result = client_sync.sessions.extract(
+        id=sess_id,
+        instruction=get_results_check_instruction(request.brand, request.model, request.year),
+        schema=RESULTS_CHECK_SCHEMA
+    )
+
+    if not check_result.data.result.get("has_results", False):
+        progress_callback(f"❌ [{site_name.upper()}] Sin resultados.")
+        return "NO_RESULTS"
+
+    # Si hay resultados, capturamos la URL actual con filtros aplicados y continuamos
+    url_res = client_sync.sessions.extract(
+        id=sess_id,
+        instruction="Obtén la URL actual de la página.",
+        schema=CURRENT_URL_SCHEMA
+    )
+    current_url = url_res.data.result.get("url", target_url)
+    progress_callback(f"✅ [{site_name.upper()}] Resultados confirmados. Extrayendo...")
+
+    # --- EXTRACCIÓN DETALLADA (Navegando a cada publicación) ---
+    all_extracted_items = []
+    max_pubs = 5  # Límite heredado a los módulos
+
+    if "kavak" in site_name:
+        kavak_module = load_scraper_module("prueba scrap kavak.py")
+        all_extracted_items = kavak_module.extract_kavak_details(
+            client_sync, sess_id, current_url, max_pubs, request.version, MODEL_NAME, site_ext_instr, request.custom_fields, progress_callback=lambda m: progress_callback(f"[{site_name.upper()}] {m}")
+        )
+    elif "mercadolibre" in site_name:
+        meli_module = load_scraper_module("prueba scrap meli.py")
+        all_extracted_items = meli_module.extract_meli_details(
+            client_sync, sess_id, current_url, max_pubs, request.version, MODEL_NAME, site_ext_instr, request.custom_fields, progress_callback=lambda m: progress_callback(f"[{site_name.upper()}] {m}")
+        )
+    else:
+        progress_callback(f"⚠️ [{site_name.upper()}] No soportado.")
+
+    if not all_extracted_items:
+        progress_callback(f"⚠️ [{site_name.upper()}] No se extrajeron publicaciones.")
+    else:
+        progress_callback(f"✅ [{site_name.upper()}] Extracción finalizada.")
+
+    return {"site": site_name, "autos": all_extracted_items}
+
 @app.post("/scrape")
 async def scrape_cars(request: ScrapeRequest):
     logger.info(f"🚀 Iniciando Scraping Optimizado: {request.brand} {request.model} ({request.year})")
@@ -418,11 +940,6 @@ async def scrape_cars(request: ScrapeRequest):
     if Stagehand is None:
         raise HTTPException(status_code=500, detail="Stagehand SDK no encontrado.")
 
-    os.environ["MODEL_API_KEY"] = request.api_key
-    os.environ["GEMINI_API_KEY"] = request.api_key
-    model_name = "google/gemini-2.5-flash"  # Modelo optimizado para tareas de navegación y extracción con contexto amplio
-    #model_name = "google/gemini-3-flash-preview"
-
     async def event_generator():
         loop = asyncio.get_running_loop()
         queue = asyncio.Queue()
@@ -434,123 +951,15 @@ async def scrape_cars(request: ScrapeRequest):
             # Enviamos al frontend de forma segura entre hilos
             loop.call_soon_threadsafe(queue.put_nowait, {"type": "status", "message": msg})
 
-        def send_error(msg, screenshot=None):
-            logger.error(f"❌ {msg}")
-            # Enviamos el error y la captura opcional al frontend
-            loop.call_soon_threadsafe(queue.put_nowait, {"type": "error", "message": msg, "screenshot": screenshot})
-
-        # 1. Obtener tipo de cambio
+        # 1. Obtener tipo de cambio (en paralelo con el scraping: sólo se usa al normalizar)
         log_status(f" Buscando {request.brand} {request.model} ({request.year})...")
         log_status("💵 Actualizando tipo de cambio...")
-        exchange_rate = await get_exchange_rate()
-        log_status(f"✅ Tipo de cambio: {exchange_rate} ARS/USD")
+        exchange_task = asyncio.create_task(get_exchange_rate())
 
-        def run_site_scraping(site_name, target_url, progress_callback):
-            # Extraer el dominio dinámicamente de la URL solicitada
-            parsed_url = urlparse(target_url)
-            domain = site_name
-            
-            # --- NAVEGACIÓN ASISTIDA POR IA (Stagehand) ---
-            progress_callback(f"🌐 [{site_name.upper()}] Iniciando Agente...")
-            client_sync = Stagehand(
-                server="local",
-                model_api_key=request.api_key,
-                local_headless=request.headless,
-                local_ready_timeout_s=20.0, 
-                timeout=600.0
-            )
-            
-            session = client_sync.sessions.start(
-                model_name=model_name,
-                browser={"type": "local", "launchOptions": {"headless": request.headless}},
-            )
-            sess_id = session.data.session_id
-            
-            client_sync.sessions.navigate(id=sess_id, url=target_url)
-
-            # Seleccionar instrucción según el sitio
-            site_nav_instr = request.nav_instr_kavak if "kavak" in site_name else request.nav_instr_meli
-            site_ext_instr = request.ext_instr_kavak if "kavak" in site_name else request.ext_instr_meli
-
-            # Formatear instrucciones de extracción si contienen variables dinámicas
-            if site_ext_instr:
-                try:
-                    site_ext_instr = site_ext_instr.format(
-                        marca=request.brand, modelo=request.model, 
-                        anio=request.year, version=request.version
-                    )
-                except: pass
-
-            instruction = get_full_navigation_instruction(domain, request.brand, request.model, request.year, request.version, site_nav_instr)
-            
-            try:
-                progress_callback(f"🤖 [{site_name.upper()}] Agente IA navegando...")
-                client_sync.sessions.execute(
-                    id=sess_id,
-                    execute_options={
-                        "instruction": instruction,
-                        "max_steps": 20,
-                    },
-                    agent_config={"model": {"model_name": model_name}},
-                )
-            except Exception as e:
-                screenshot = None
-                try:
-                    ss = client_sync.sessions.screenshot(id=sess_id)
-                    screenshot = ss.data.base64
-                except: pass
-                send_error(f"Error en {site_name}: {str(e)}", screenshot)
-                return "ERROR"
-
-            # Verificación rápida de resultados para detener el proceso si no hay nada
-            progress_callback(f"🧐 [{site_name.upper()}] Verificando resultados...")
-            check_result = client_sync.sessions.extract(
-                id=sess_id,
-                instruction=f"Analiza la página actual. ¿Se aplicaron correctamente los filtros de Marca (puede tener otros nombres considerar todas las variantes posibles): '{request.brand}', Modelo  (puede tener otros nombres considerar todas las variantes posibles): '{request.model}' y Año  (puede tener otros nombres considerar todas las variantes posibles): '{request.year}'? ¿La página muestra resultados que coinciden con estos filtros, o muestra un mensaje de '0 resultados' o 'No se encontraron vehículos'? Responde false si los filtros no se aplicaron correctamente o si no hay resultados que coincidan con la búsqueda.",
-                schema={"type": "object", "properties": {"has_results": {"type": "boolean"}}}
-            )
-            
-            if not check_result.data.result.get("has_results", False):
-                progress_callback(f"❌ [{site_name.upper()}] Sin resultados.")
-                client_sync.sessions.end(id=sess_id)
-                client_sync.close()
-                return "NO_RESULTS"
-
-            # Si hay resultados, capturamos la URL actual con filtros aplicados y continuamos
-            url_res = client_sync.sessions.extract(
-                id=sess_id,
-                instruction="Obtén la URL actual de la página.",
-                schema={"type": "object", "properties": {"url": {"type": "string","format": "uri"}}}
-            )
-            current_url = url_res.data.result.get("url", target_url)
-            progress_callback(f"✅ [{site_name.upper()}] Resultados confirmados. Extrayendo...")
-
-            # --- EXTRACCIÓN DETALLADA (Navegando a cada publicación) ---
-            all_extracted_items = []
-            max_pubs = 5  # Límite heredado a los módulos
-            
-            if "kavak" in site_name:
-                kavak_module = load_scraper_module("prueba scrap kavak.py")
-                all_extracted_items = kavak_module.extract_kavak_details(
-                    client_sync, sess_id, current_url, max_pubs, request.version, model_name, site_ext_instr, request.custom_fields, progress_callback=lambda m: progress_callback(f"[{site_name.upper()}] {m}")
-                )
-            elif "mercadolibre" in site_name:
-                meli_module = load_scraper_module("prueba scrap meli.py")
-                all_extracted_items = meli_module.extract_meli_details(
-                    client_sync, sess_id, current_url, max_pubs, request.version, model_name, site_ext_instr, request.custom_fields, progress_callback=lambda m: progress_callback(f"[{site_name.upper()}] {m}")
-                )
-            else:
-                progress_callback(f"⚠️ [{site_name.upper()}] No soportado.")
-
-            client_sync.sessions.end(id=sess_id)
-            client_sync.close()
-
-            if not all_extracted_items:
-                progress_callback(f"⚠️ [{site_name.upper()}] No se extrajeron publicaciones.")
-            else:
-                progress_callback(f"✅ [{site_name.upper()}] Extracción finalizada.")
-
-            return {"site": site_name, "autos": all_extracted_items}
+        # Scrapings compartidos a los que está suscripta la cola de este request
+        subscriptions = []
+        # Si este request lanzó algún scraping, su persistencia usa este tipo de cambio
+        exchange_shared = False
 
         try:
             # Ejecutar lógica en paralelo para ambos sitios
@@ -558,143 +967,113 @@ async def scrape_cars(request: ScrapeRequest):
             for site_key in request.sites:
                 site_key_lower = site_key.lower().replace(" ", "")
                 if site_key_lower in SITE_URLS:
-                    tasks.append(asyncio.create_task(asyncio.to_thread(run_site_scraping, site_key_lower, SITE_URLS[site_key_lower], log_status)))
-            
-            # Monitorear la cola de mensajes mientras las tareas corren
-            while any(not t.done() for t in tasks) or not queue.empty():
-                try:
-                    msg = await asyncio.wait_for(queue.get(), timeout=0.1)
-                    yield json.dumps(msg) + "\n"
-                except asyncio.TimeoutError:
+                    key = site_scrape_key(request, site_key_lower)
+                    shared = _INFLIGHT_SCRAPES.get(key)
+                    cached = None if shared else get_cached_site_result(key)
+                    if cached is not None:
+                        # Sus publicaciones ya se persistieron al terminar aquel scraping
+                        log_status(f"♻️ [{site_key_lower.upper()}] Usando resultados recientes de una búsqueda idéntica...")
+                        future = loop.create_future()
+                        future.set_result(cached)
+                    else:
+                        if shared is None:
+                            shared = start_shared_scrape(loop, key, request, site_key_lower, exchange_task)
+                            exchange_shared = True
+                        else:
+                            log_status(f"🔗 [{site_key_lower.upper()}] Hay un scraping idéntico en curso, se reutiliza su resultado...")
+                        shared.queues.append(queue)
+                        subscriptions.append(shared)
+                        future = shared.future
+                    # shield: si este request se cancela no cancela el scraping de los demás
+                    task = asyncio.shield(future)
+                    # Al terminar, cada tarea encola un None que marca su fin
+                    task.add_done_callback(lambda _: queue.put_nowait(None))
+                    tasks.append(task)
+
+            # Reenviar mensajes de la cola hasta que todas las tareas hayan terminado
+            # (sin sondeo por timeout: cada get() despierta sólo cuando hay algo)
+            pending = len(tasks)
+            while pending:
+                msg = await queue.get()
+                if msg is None:
+                    pending -= 1
                     continue
+                yield ndjson_line(msg)
 
             # Recopilar resultados de todas las tareas
             all_site_results = await asyncio.gather(*tasks, return_exceptions=True)
-            
+            exchange_rate = await exchange_task
+            log_status(f"✅ Tipo de cambio: {exchange_rate} ARS/USD")
+
             log_status("📊 Procesando datos extraídos de todos los sitios...")
             
-            site_averages = {}
-            for raw_results in all_site_results:
-                if isinstance(raw_results, Exception):
-                    logger.error(f"❌ Error en tarea de scraping: {raw_results}")
-                    continue
-                
-                if raw_results in ("NO_RESULTS", "ERROR"): continue
+            for failure in (r for r in all_site_results if isinstance(r, Exception)):
+                logger.error(f"❌ Error en tarea de scraping: {failure}")
 
+            site_averages = {}
+            # Acumuladores del promedio general: se suman los totales de cada sitio
+            # en lugar de recorrer de nuevo todas las publicaciones al final
+            price_sum, price_count = 0.0, 0
+            for raw_results in [r for r in all_site_results if isinstance(r, dict)]:
                 items = raw_results.get("autos", [])
                 site_name = raw_results.get("site", "Desconocido").lower()
                 
                 if items:
                     log_status(f" Analizando {len(items)} resultados de {site_name.upper()}...")
-                    processed_items_for_site = []
-                    for idx, item in enumerate(items, 1):
-                        log_status(f"⚙️ [{site_name.upper()}] Procesando publicación {idx}/{len(items)}...")
-                        try:
-                            def clean_num(v):
-                                if v is None: return 0.0
-                                s = "".join(c for c in str(v).replace(',', '.') if c.isdigit() or c == '.')
-                                try:
-                                    return float(s) if s else 0.0
-                                except: return 0.0
-
-                            price = clean_num(item.get('precio', item.get('price', item.get('precio_contado', 0))))
-                            currency = str(item.get('moneda', item.get('currency', 'ARS'))).upper()
-                            price_ars = price * exchange_rate if currency == 'USD' else price
-                            km = int(clean_num(item.get('km', item.get('kilometraje', 0))))
-                            year = int(clean_num(item.get('año', item.get('year', request.year))))
-                            raw_link = str(item.get('link', item.get('url', '')))
-                            full_link = urljoin(SITE_URLS.get(site_name, ""), raw_link)
-                            
-                            # Definir campos que ya son parte del esquema estándar (incluyendo sinónimos)
-                            standard_keys = {
-                                'title', 'titulo', 'year', 'año', 'km', 'kilometraje', 'precio', 'price', 
-                                'precio_contado', 'moneda', 'currency', 'combustible', 'transmision', 
-                                'marca', 'brand', 'modelo', 'model', 'version', 'ubicacion', 'zona', 
-                                'url', 'link', 'fecha_publicacion', 'reservado'
-                            }
-                            # Guardar en custom_data SOLO los campos que el usuario solicitó explícitamente
-                            # y que no colisionan con los campos estándar ya procesados.
-                            custom_data = {k: v for k, v in item.items() if k in request.custom_fields and k not in standard_keys}
-
-
-                            extracted_data.append({
-                                "brand": str(item.get('marca', item.get('brand', request.brand))),
-                                "model": str(item.get('modelo', item.get('model', request.model))),
-                                "version": str(item.get('version', 'N/A')),
-                                "year": year, "km": km, "price": price, "currency": currency,
-                                "price_ars": price_ars, "title": str(item.get('titulo', item.get('title', 'N/A'))),
-                                "combustible": str(item.get('combustible', 'N/A')),
-                                "transmision": str(item.get('transmision', 'N/A')),
-                                "zona": str(item.get('zona', item.get('ubicacion', 'N/A'))),
-                                "fecha_publicacion": str(item.get('fecha_publicacion', 'N/A')),
-                                "reservado": bool(item.get('reservado', False)),
-                                "custom_data": custom_data,
-                                "url": full_link, "site": site_name.capitalize()
-                            })
-                            processed_items_for_site.append(extracted_data[-1])
-                        except: continue
-                    
+                    try:
+                        processed_items_for_site = normalize_site_items(items, site_name, request, exchange_rate)
+                    except Exception as e:
+                        logger.error(f"❌ Error normalizando resultados de {site_name}: {e}")
+                        continue
+                    extracted_data.extend(processed_items_for_site)
+
                     if processed_items_for_site:
-                        site_df = pd.DataFrame(processed_items_for_site)
-                        avg = site_df[site_df['price_ars'] > 0]['price_ars'].mean()
-                        site_averages[site_name] = float(avg) if pd.notnull(avg) and math.isfinite(avg) else 0.0
+                        site_sum, site_count = price_totals(processed_items_for_site)
+                        price_sum += site_sum
+                        price_count += site_count
+                        site_averages[site_name] = average_of(site_sum, site_count)
                         log_status(f"✅ [{site_name.upper()}] Datos normalizados correctamente.")
 
             # Respuesta Final
             if extracted_data:
-                df = pd.DataFrame(extracted_data)
-                
-                if not df.empty:
-                    os.makedirs(os.path.dirname(DATA_FILE), exist_ok=True)
-                    all_data = []
-                    if os.path.exists(DATA_FILE):
-                        try:
-                            with open(DATA_FILE, "r") as f: all_data = json.load(f)
-                        except: pass
-                    all_data.extend(df.to_dict('records'))
-                    with open(DATA_FILE, "w") as f: json.dump(all_data, f, indent=4)
-                    
-                    res_stats = {
-                        "average_price": float(df[df['price_ars'] > 0]['price_ars'].mean()) if not df[df['price_ars'] > 0].empty else 0.0, 
-                        "count": len(df)
-                    }
-
-                    # Persistencia en DB por sitio para actualizar columnas específicas
-                    updated_stock = save_to_db(extracted_data, site_averages, request, progress_callback=log_status)
-                    
-                    log_status("✅ Scraping y valuación finalizados con éxito.")
-
-                    # Helper para serializar tipos no estándar de la base de datos (Decimal, datetime, date)
-                    def json_serial(obj):
-                        if isinstance(obj, (datetime, date)):
-                            return obj.isoformat()
-                        if isinstance(obj, Decimal):
-                            val = float(obj)
-                            return val if math.isfinite(val) else 0.0
-                        raise TypeError(f"Type {type(obj)} not serializable")
-
-                    yield json.dumps({
-                        "type": "final",
-                        "status": "success", "data": df.to_dict('records'),
-                        "exchange_rate": exchange_rate,
-                        "stats": res_stats,
-                        "updated_stock": updated_stock,
-                        "message": f"Se extrajeron {len(df)} publicaciones exitosamente."
-                    }, default=json_serial) + "\n"
-                else:
-                    yield json.dumps({"type": "final", "status": "empty", "message": "No se encontraron publicaciones válidas."}) + "\n"
+                res_stats = {
+                    "average_price": average_of(price_sum, price_count),
+                    "count": len(extracted_data)
+                }
+
+                # Valuación en DB con los promedios del request (las publicaciones las guarda
+                # persist_shared_scrape al terminar cada scraping)
+                updated_stock = await asyncio.to_thread(save_to_db, site_averages, request, progress_callback=log_status)
+
+                log_status("✅ Scraping y valuación finalizados con éxito.")
+
+                yield ndjson_line({
+                    "type": "final",
+                    "status": "success", "data": extracted_data,
+                    "exchange_rate": exchange_rate,
+                    "stats": res_stats,
+                    "updated_stock": updated_stock,
+                    "message": f"Se extrajeron {len(extracted_data)} publicaciones exitosamente."
+                })
             else:
-                yield json.dumps({"type": "final", "status": "empty", "message": "No se encontraron publicaciones válidas."}) + "\n"
+                yield ndjson_line({"type": "final", "status": "empty", "message": "No se encontraron publicaciones válidas."})
 
         except Exception as e:
             logger.error(f"❌ Error en el proceso de scraping: {str(e)}")
             logger.error(traceback.format_exc())
-            yield json.dumps({"type": "final", "status": "error", "message": str(e)}) + "\n"
+            yield ndjson_line({"type": "final", "status": "error", "message": str(e)})
+        finally:
+            # Si el stream terminó antes de usarlo (desconexión o error), no queda colgado;
+            # salvo que lo espere la persistencia de un scraping lanzado por este request
+            if not exchange_shared:
+                exchange_task.cancel()
+            for shared in subscriptions:
+                shared.queues.remove(queue)
 
     return StreamingResponse(event_generator(), media_type="application/x-ndjson")
 
 @app.get("/history/extractions")
-async def get_extractions_history():
+def get_extractions_history():
     """Obtiene el historial de extracciones crudas."""
     try:
         conn = get_db_connection()
@@ -717,8 +1096,33 @@ async def get_extractions_history():
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/history/publicaciones")
+async def get_publicaciones_history():
+    """Devuelve en streaming el historial local de publicaciones (JSON Lines)."""
+    async def line_generator():
+        await flush_history()
+        # Un único open (sin os.path.exists previo): si todavía no hay historial, no hay nada que leer
+        try:
+            f = await aiofiles.open(DATA_FILE, "rb")
+        except FileNotFoundError:
+            return
+        try:
+            # Sólo hasta el tamaño actual: lo que otro worker agregue mientras tanto
+            # queda para el próximo request (la memoria usada es un bloque, no el archivo)
+            remaining = await f.seek(0, os.SEEK_END)
+            await f.seek(0)
+            # Bloques grandes: cada lectura de aiofiles es un salto al threadpool,
+            # iterar línea por línea pagaría ese salto por cada publicación
+            while remaining > 0 and (chunk := await f.read(min(HISTORY_READ_CHUNK, remaining))):
+                remaining -= len(chunk)
+                yield chunk
+        finally:
+            await f.close()
+
+    return StreamingResponse(line_generator(), media_type="application/x-ndjson")
+
 @app.get("/history/valuations")
-async def get_valuations_history():
+def get_valuations_history():
     """Obtiene el historial de valuaciones calculadas de negocio."""
     try:
         conn = get_db_connection()
@@ -749,4 +1153,16 @@ async def get_valuations_history():
 
 if __name__ == "__main__":
     port = int(os.getenv("BACKEND_PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
\ No newline at end of file
+    # Cada worker es un proceso aparte con su propio estado: pool de navegadores, scrapings
+    # en curso y caché de resultados por sitio. Por defecto uno solo (cada worker extra
+    # suma navegadores); el historial JSONL sí es compartido (append).
+    workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+    # loop="none": uvicorn respeta la política de loop instalada al importar el módulo.
+    # Sin access log y uvicorn sólo en warning: el progreso ya se registra con logger en cada etapa.
+    # Con varios workers uvicorn necesita la app como import string.
+    uvicorn.run(
+        "main:app" if workers > 1 else app,
+        host="0.0.0.0", port=port, workers=workers,
+        loop="none", http="httptools", access_log=False,
+        log_level=os.getenv("UVICORN_LOG_LEVEL", "warning")
+    )
\ No newline at end of file
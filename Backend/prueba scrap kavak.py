@@ -1,66 +1,67 @@
-import asyncio
-import sys
 import logging
-import json
-import os
-import re
-import pandas as pd
-from urllib.parse import urlparse, urljoin
-import uvicorn
-import time
-from fastapi import FastAPI, HTTPException
-from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from dotenv import load_dotenv
-from playwright.sync_api import sync_playwright
+import string
+from functools import lru_cache
+from scrape_utils import TranslateTable, build_detail_properties, make_notifier, make_token_logger, navigate_and_wait, settle_after_action
 try:
     from stagehand import Stagehand
 except ImportError:
     Stagehand = None
 
+# Campos que Kavak agrega al esquema de detalle estándar
+KAVAK_DETAIL_PROPERTIES = {
+    "reservado": {"type": "boolean", "description": "Indica si el vehículo aparece como 'Reservado'"},
+    "version_match": {"type": "boolean", "description": "Indica si la versión coincide al menos en un 60% con la buscada"}
+}
+
+# Esquema fijo del relevamiento del listado (se construye una sola vez por proceso)
+LISTING_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "vehicles": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "title": {"type": "string"},
+                    "year": {"type": "string"},
+                    "km": {"type": "number"}
+                }
+            }
+        }
+    }
+}
+
+# Deja sólo letras (en minúscula) y dígitos, para comparar año/km del listado contra el detalle
+_ALNUM_LOWER = TranslateTable({ord(c): c.lower() for c in string.ascii_letters + string.digits})
+
+def _norm(value):
+    return str(value).translate(_ALNUM_LOWER)
+
+@lru_cache(maxsize=32)
+def _listing_instruction(max_publications):
+    """Instrucción de relevamiento del listado (memoizada por límite de publicaciones)."""
+    return f"Localiza la lista principal de resultados (ignora anuncios y recomendados). Extrae el título, año y kilometraje (solo el número, interpretando 'k' como mil, ej: 136k km = 136000) de los primeros {max_publications} vehículos."
+
+@lru_cache(maxsize=256)
+def _detail_instruction(target_version):
+    """Instrucción de extracción del detalle (memoizada por versión buscada)."""
+    return (
+        "Extrae el título principal, año, kilometraje (solo el número, interpretando 'k' como mil, ej: 136k km = 136000), precio al contado (solo el número, sin símbolos ni separadores), moneda (ARS o USD), combustible, transmisión, marca, modelo, versión, ubicación y la URL actual de la página. REGLA CRÍTICA: Extrae el precio ÚNICAMENTE de la sección de información principal del vehículo. Si el vehículo está 'Reservado' y no tiene precio propio visible, pon 0. Ignora terminantemente precios de banners de 'Otras opciones de compra', carruseles de 'autos similares' o recomendaciones.\n"
+        f"**FILTRO CRÍTICO:** Compara la versión del vehículo con '{target_version}'. Si la coincidencia es menor al 60%, establece 'version_match' en false. De lo contrario, true."
+    )
+
 def extract_kavak_details(client_sync, sess_id, results_url, max_publications, target_version, model_name, custom_instruction=None, custom_fields=None, progress_callback=None):
     """Extrae detalles de publicaciones de Kavak utilizando la lógica de navegación y clic."""
     logger = logging.getLogger(__name__)
-
-    def notify(msg):
-        if progress_callback:
-            progress_callback(msg)
-        logger.info(msg)
-
-    usage_stats = {"total_tokens": 0}
-
-    def log_token_usage(action_name):
-        """Obtiene y muestra el uso de tokens acumulado y el delta de la acción."""
-        try:
-            metrics = client_sync.sessions.get_metrics(id=sess_id) # Retoma la sesión heredada
-            new_total = metrics.data.total_tokens
-            delta = new_total - usage_stats["total_tokens"]
-            usage_stats["total_tokens"] = new_total
-            logger.info(f"📊 [Tokens] {action_name} - Usados: {delta} | Total acumulado: {new_total}")
-        except Exception as e:
-            logger.debug(f"⚠️ No se pudieron obtener métricas: {e}")
+    notify = make_notifier(progress_callback, logger)
+    log_token_usage = make_token_logger(client_sync, sess_id, logger)
 
     # 1. Extraer datos de los vehículos en una sola llamada (Eficiencia)
     try:
         listings_info = client_sync.sessions.extract(
             id=sess_id,
-            instruction=f"Localiza la lista principal de resultados (ignora anuncios y recomendados). Extrae el título, año y kilometraje (solo el número, interpretando 'k' como mil, ej: 136k km = 136000) de los primeros {max_publications} vehículos.",
-            schema={
-                "type": "object",
-                "properties": {
-                    "vehicles": {
-                        "type": "array",
-                        "items": {
-                            "type": "object",
-                            "properties": {
-                                "title": {"type": "string"},
-                                "year": {"type": "string"},
-                                "km": {"type": "number"}
-                            }
-                        }
-                    }
-                }
-            }
+            instruction=_listing_instruction(max_publications),
+            schema=LISTING_SCHEMA
         )
         vehicles = listings_info.data.result.get("vehicles", [])
         if not vehicles:
@@ -73,6 +74,10 @@ def extract_kavak_details(client_sync, sess_id, results_url, max_publications, t
 
     log_token_usage("Conteo inicial")
     
+    instruction = custom_instruction or _detail_instruction(target_version)
+    # Esquema dinámico (campos personalizados): se arma una vez para todos los vehículos e intentos
+    detail_schema = {"type": "object", "properties": build_detail_properties(custom_fields, extra=KAVAK_DETAIL_PROPERTIES)}
+
     all_extracted_items = []
     for i, v_data in enumerate(vehicles, 1):
         notify(f"🖱️ Procesando vehículo #{i} de {len(vehicles)}...")
@@ -83,8 +88,7 @@ def extract_kavak_details(client_sync, sess_id, results_url, max_publications, t
         success = False
         for attempt in range(3):  # Reintento hasta 3 veces por publicación
             try:
-                client_sync.sessions.navigate(id=sess_id, url=results_url) # Vuelve a la lista filtrada
-                time.sleep(2)
+                navigate_and_wait(client_sync, sess_id, results_url) # Vuelve a la lista filtrada
 
                 notify(f"🔍 Abriendo detalle del vehículo #{i}...")
                 client_sync.sessions.execute(
@@ -95,34 +99,12 @@ def extract_kavak_details(client_sync, sess_id, results_url, max_publications, t
                     },
                     agent_config={"model": {"model_name": model_name}}
                 )
-                time.sleep(5)
-
-                # Construir esquema dinámico para soportar campos personalizados
-                properties = {
-                    "title": {"type": "string"}, "year": {"type": "string"}, "km": {"type": "number"},
-                    "precio_contado": {"type": "number"}, "moneda": {"type": "string"},
-                    "combustible": {"type": "string"}, "transmision": {"type": "string"},
-                    "marca": {"type": "string"}, "modelo": {"type": "string"},
-                    "version": {"type": "string"}, "ubicacion": {"type": "string"},
-                    "url": {"type": "string", "format": "uri"},
-                    "reservado": {"type": "boolean", "description": "Indica si el vehículo aparece como 'Reservado'"},
-                    "version_match": {"type": "boolean", "description": "Indica si la versión coincide al menos en un 60% con la buscada"}
-                }
-                if custom_fields:
-                    for field in custom_fields:
-                        properties[field] = {"type": "string"}
-
-                instruction = custom_instruction or (
-                    "Extrae el título principal, año, kilometraje (solo el número, interpretando 'k' como mil, ej: 136k km = 136000), precio al contado (solo el número, sin símbolos ni separadores), moneda (ARS o USD), combustible, transmisión, marca, modelo, versión, ubicación y la URL actual de la página. REGLA CRÍTICA: Extrae el precio ÚNICAMENTE de la sección de información principal del vehículo. Si el vehículo está 'Reservado' y no tiene precio propio visible, pon 0. Ignora terminantemente precios de banners de 'Otras opciones de compra', carruseles de 'autos similares' o recomendaciones.\n"
-                    f"**FILTRO CRÍTICO:** Compara la versión del vehículo con '{target_version}'. Si la coincidencia es menor al 60%, establece 'version_match' en false. De lo contrario, true."
-                )
+                settle_after_action()
 
                 detail_check = client_sync.sessions.extract(
                     id=sess_id,
                     instruction=instruction,
-                    schema={
-                        "type": "object", "properties": properties
-                    }
+                    schema=detail_schema
                 )
                 item = detail_check.data.result
                 if item:
@@ -137,10 +119,8 @@ def extract_kavak_details(client_sync, sess_id, results_url, max_publications, t
                     notify(f"📄 Detalle: {detail_year} | {detail_km}")
 
                     # Validación de Encabezado, Año y KM
-                    def norm(s): return re.sub(r'[^a-zA-Z0-9]', '', str(s)).lower()
-                    
-                    year_match = norm(listing_year) == norm(detail_year)
-                    km_match = norm(listing_km) == norm(detail_km)
+                    year_match = _norm(listing_year) == _norm(detail_year)
+                    km_match = _norm(listing_km) == _norm(detail_km)
 
                     if year_match and km_match:
                         logger.info(f"✅ Validación exitosa para vehículo #{i}")
@@ -203,8 +183,7 @@ def main() -> None:
     sess_id = session.data.session_id
     
     logger.info(f"📍 Navegando a la lista de resultados: {results_url}")
-    client_sync.sessions.navigate(id=sess_id, url=results_url)
-    time.sleep(5) # Espera aumentada para asegurar que el DOM esté completamente cargado
+    navigate_and_wait(client_sync, sess_id, results_url)
 
     # Llamada a la función modularizada para pruebas
     results = extract_kavak_details(client_sync, sess_id, results_url, max_publications, target_version, model_name)
@@ -2,6 +2,7 @@
 import os
 import sys
 from stagehand import Stagehand
+from scrape_utils import navigate_and_wait
 
 # Usamos GEMINI_API_KEY o MODEL_API_KEY
 #api_key = model_name = os.environ.get("MODEL_API_KEY")
@@ -31,11 +32,9 @@ try:
     # CORRECCIÓN DE URL
     target_url = "https://www.kavak.com" 
     print(f"\n📍 Navegando a {target_url}...")
-    client.sessions.navigate(id=session_id, url=target_url)
-    
-    # Pausa real para que el sitio termine de cargar scripts internos
-    import time
-    time.sleep(2) 
+    # Espera a que la red quede inactiva (el sitio termina de cargar scripts internos);
+    # si nunca queda inactiva, navigate_and_wait sigue con una navegación simple
+    navigate_and_wait(client, session_id, target_url)
     
     print("ejecuto prueba...")
     #response = client.sessions.act(
@@ -1,5 +1,4 @@
-import json
-import time
+import orjson
 import re
 import requests
 from playwright.sync_api import sync_playwright, TimeoutError
@@ -13,6 +12,7 @@ MAX_CHARS = 1200           # 👈 evita truncados en Ollama
  
 OLLAMA_URL = "http://localhost:11434/api/generate"
 OLLAMA_MODEL = "llama3:latest"   # o el que tengas
+COOKIES_BUTTON = re.compile("Aceptar", re.I)   # 👈 compilado una sola vez
  
 # =====================
 # HELPERS
@@ -54,17 +54,18 @@ def try_fix_json(text):
         text += "}"
  
     try:
-        return json.loads(text)
+        return orjson.loads(text)
     except:
         return None
  
  
 def parse_ollama_response(text):
-    match = re.search(r"\{[\s\S]*", text)
-    if not match:
+    # Desde la primera llave hasta el final (descarta fences ```json y texto previo)
+    _, brace, tail = text.partition("{")
+    if not brace:
         return None
  
-    return try_fix_json(match.group(0))
+    return try_fix_json(brace + tail)
  
  
 # =====================
@@ -75,7 +76,7 @@ def scrape_list(page):
     page.goto(LIST_URL, wait_until="domcontentloaded", timeout=90000)
  
     try:
-        page.get_by_role("button", name=re.compile("Aceptar", re.I)).click(timeout=4000)
+        page.get_by_role("button", name=COOKIES_BUTTON).click(timeout=4000)
         print("🍪 Cookies aceptadas")
     except:
         pass
@@ -108,7 +109,11 @@ def scrape_details(page, auto):
         print("⚠️ Timeout detalle")
         return auto
  
-    time.sleep(2)
+    # Espera a que aparezca el encabezado de la publicación (tope 2 s, como la pausa anterior)
+    try:
+        page.wait_for_selector("div.ui-pdp-header", timeout=2000)
+    except TimeoutError:
+        pass
  
     def grab(selector):
         el = page.query_selector(selector)
@@ -193,8 +198,8 @@ def main():
  
         browser.close()
  
-    with open("autos_final.json", "w", encoding="utf-8") as f:
-        json.dump(results, f, ensure_ascii=False, indent=2)
+    with open("autos_final.json", "wb") as f:
+        f.write(orjson.dumps(results, option=orjson.OPT_INDENT_2))
  
     print("💾 autos_final.json generado")
  
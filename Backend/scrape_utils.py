@@ -0,0 +1,86 @@
+import logging
+import time
+
+# Campos estándar que se piden al extraer el detalle de una publicación.
+BASE_DETAIL_PROPERTIES = {
+    "title": {"type": "string"}, "year": {"type": "string"}, "km": {"type": "number"},
+    "precio_contado": {"type": "number"}, "moneda": {"type": "string"},
+    "combustible": {"type": "string"}, "transmision": {"type": "string"},
+    "marca": {"type": "string"}, "modelo": {"type": "string"},
+    "version": {"type": "string"}, "ubicacion": {"type": "string"},
+    "url": {"type": "string", "format": "uri"},
+    "reservado": {"type": "boolean"}
+}
+
+class TranslateTable(dict):
+    """Tabla para str.translate que borra todo carácter no mapeado explícitamente.
+
+    Los caracteres no previstos se agregan a la tabla la primera vez que aparecen,
+    así las búsquedas siguientes se resuelven en C sin volver a Python.
+    """
+    def __missing__(self, key):
+        self[key] = None
+        return None
+
+# Margen corto tras una acción del agente (clic/paginación): el extract posterior de
+# Stagehand ya espera a que el DOM se estabilice.
+POST_ACTION_SETTLE_S = 1.0
+NAVIGATION_TIMEOUT_MS = 15000
+
+def navigate_and_wait(client_sync, sess_id, url, timeout_ms=NAVIGATION_TIMEOUT_MS, logger=None):
+    """Navega y espera a que la red quede inactiva, en lugar de dormir un tiempo fijo.
+
+    En sitios con mucha publicidad/analítica la red puede no quedar nunca inactiva: si
+    esa espera falla se reintenta una navegación simple (sin wait_until). Un error real
+    de navegación (URL inválida, red, sesión caída) vuelve a fallar ahí y se propaga.
+    """
+    logger = logger or logging.getLogger(__name__)
+    try:
+        client_sync.sessions.navigate(
+            id=sess_id, url=url,
+            options={"wait_until": "networkidle", "timeout": timeout_ms}
+        )
+    except Exception as e:
+        logger.warning(f"⚠️ La página no quedó inactiva en {timeout_ms} ms, se reintenta sin esperar la red: {e}")
+        client_sync.sessions.navigate(id=sess_id, url=url)
+
+def settle_after_action():
+    time.sleep(POST_ACTION_SETTLE_S)
+
+def make_notifier(progress_callback=None, logger=None):
+    """Devuelve una función que reporta el progreso al callback (si existe) y al log."""
+    logger = logger or logging.getLogger(__name__)
+
+    def notify(msg):
+        if progress_callback:
+            progress_callback(msg)
+        logger.info(msg)
+
+    return notify
+
+def make_token_logger(client_sync, sess_id, logger=None):
+    """Devuelve una función que registra el uso de tokens acumulado y el delta de cada acción."""
+    logger = logger or logging.getLogger(__name__)
+    usage_stats = {"total_tokens": 0}
+
+    def log_token_usage(action_name):
+        try:
+            metrics = client_sync.sessions.get_metrics(id=sess_id) # Retoma la sesión heredada
+            new_total = metrics.data.total_tokens
+            delta = new_total - usage_stats["total_tokens"]
+            usage_stats["total_tokens"] = new_total
+            logger.info(f"📊 [Tokens] {action_name} - Usados: {delta} | Total acumulado: {new_total}")
+        except Exception as e:
+            logger.debug(f"⚠️ No se pudieron obtener métricas: {e}")
+
+    return log_token_usage
+
+def build_detail_properties(custom_fields=None, extra=None):
+    """Arma las propiedades del esquema de detalle, sumando campos propios del sitio y del usuario."""
+    properties = dict(BASE_DETAIL_PROPERTIES)
+    if extra:
+        properties.update(extra)
+    if custom_fields:
+        for field in custom_fields:
+            properties[field] = {"type": "string"}
+    return properties
@@ -1,5 +1,19 @@
 const { Stagehand } = require("stagehand");
-const fs = require("fs");
+
+// stdout queda reservado para los resultados (NDJSON); los logs van a stderr
+const log = (...args) => console.error(...args);
+
+// Espera a que el documento esté completo y la red inactiva, con un tope de tiempo.
+// Si la página no se estabiliza a tiempo se continúa igual: el extract trabaja
+// sobre lo que ya esté cargado.
+async function waitForPageReady(page, timeoutMs = 10000) {
+  try {
+    await page.waitForFunction(() => document.readyState === "complete", null, { timeout: timeoutMs, polling: 100 });
+    await page.waitForLoadState("networkidle", { timeout: timeoutMs });
+  } catch (e) {
+    log(`⚠️ La página no terminó de estabilizarse en ${timeoutMs} ms, se continúa.`);
+  }
+}
 
 async function runScraper() {
   const brand = process.argv[2];
@@ -11,11 +25,13 @@ async function runScraper() {
   // Configuramos la clave de Gemini para el motor de Stagehand
   process.env.GEMINI_API_KEY = apiKey;
 
-  console.log(`🚀 Iniciando Stagehand para: ${brand} ${model}...`);
-  
+  log(`🚀 Iniciando Stagehand para: ${brand} ${model}...`);
+
   const stagehand = new Stagehand({
     env: "local",
     verbose: 1,
+    // Los logs de la librería también van a stderr: stdout sólo lleva resultados
+    logger: (logLine) => log(`[stagehand${logLine.category ? `:${logLine.category}` : ""}] ${logLine.message}`),
     debugDom: false,
     headless: false, // Podrás ver la ventana del navegador
     modelName: "gemini-1.5-flash",
@@ -26,16 +42,16 @@ async function runScraper() {
     await stagehand.init();
     const page = stagehand.page;
 
-    console.log(`Navegando a ${url}...`);
+    log(`Navegando a ${url}...`);
     await page.goto(url, { waitUntil: "networkidle" });
 
-    console.log("IA buscando el vehículo...");
+    log("IA buscando el vehículo...");
     await stagehand.act(`Buscar autos marca ${brand}, modelo ${model}, año ${year}. Usa los filtros del sitio.`);
-    
-    // Tiempo para que los resultados carguen
-    await new Promise(resolve => setTimeout(resolve, 8000));
 
-    console.log("IA extrayendo datos estructurados...");
+    // Esperar a que los resultados carguen (en lugar de una pausa fija de 8 s)
+    await waitForPageReady(page);
+
+    log("IA extrayendo datos estructurados...");
     const results = await stagehand.extract({
       instruction: "Lista de autos con: brand, model, year (number), km (number), price (number), currency, title",
       schema: {
@@ -60,9 +76,12 @@ async function runScraper() {
       }
     });
 
-    // Guardar resultados para Python
-    fs.writeFileSync("temp_results.json", JSON.stringify(results.autos || []));
-    console.log("SUCCESS_SCRAPING_DONE");
+    // Resultados por stdout en NDJSON, un auto por línea. El extract devuelve la lista
+    // completa de una vez, así que las líneas se escriben todas juntas al terminar.
+    // Formato de salida: antes era un temp_results.json con un array; quien consuma
+    // este script debe leer stdout línea por línea.
+    for (const auto of results.autos || []) process.stdout.write(JSON.stringify(auto) + "\n");
+    log("SUCCESS_SCRAPING_DONE");
 
   } catch (error) {
     console.error("CRITICAL_ERROR:", error.message);
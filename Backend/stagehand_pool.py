@@ -0,0 +1,130 @@
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+class WarmSession:
+    """Cliente Stagehand con una sesión de navegador ya iniciada.
+
+    Iniciar la sesión lanza Chromium, así que se conserva abierta junto al cliente
+    y se reutiliza entre requests; cada scraping navega a su URL de inicio.
+    """
+
+    # Tras esta cantidad de fallos seguidos la sesión se descarta y se crea otra
+    MAX_CONSECUTIVE_FAILURES = 2
+    # Tras esta cantidad de usos se recicla igual, para no acumular memoria del navegador
+    MAX_USES = 50
+
+    def __init__(self, client, model_name, headless):
+        self.client = client
+        self.consecutive_failures = 0
+        self.uses = 0
+        try:
+            session = client.sessions.start(
+                model_name=model_name,
+                browser={"type": "local", "launchOptions": {"headless": headless}},
+            )
+        except Exception:
+            client.close()
+            raise
+        self.session_id = session.data.session_id
+
+    def record_result(self, ok):
+        self.uses += 1
+        self.consecutive_failures = 0 if ok else self.consecutive_failures + 1
+
+    @property
+    def healthy(self):
+        return self.consecutive_failures < self.MAX_CONSECUTIVE_FAILURES and self.uses < self.MAX_USES
+
+    def close(self):
+        try:
+            self.client.sessions.end(id=self.session_id)
+        except Exception as e:
+            logger.debug(f"⚠️ No se pudo cerrar la sesión {self.session_id}: {e}")
+        self.client.close()
+
+class StagehandPool:
+    """Pool de clientes Stagehand (o sesiones ya iniciadas) reutilizables entre requests.
+
+    Cada cliente local levanta su propio servidor/navegador, así que crearlo y
+    cerrarlo por request es lo más caro del scraping. Los clientes se agrupan por
+    clave (p. ej. api key, headless y sitio). max_size acota el total de navegadores
+    vivos, en uso más ociosos: si hace falta uno para una clave sin ociosos y el pool
+    está lleno, se cierra el ocioso usado hace más tiempo (de otra clave).
+    """
+
+    def __init__(self, factory, max_size=2):
+        self._factory = factory
+        self._max_size = max_size
+        self._cond = threading.Condition()
+        self._leased = 0
+        # Ociosos en orden de uso: el primero es el menos reciente
+        self._idle = []
+
+    def acquire(self, key):
+        """Toma un cliente libre para la clave o crea uno nuevo (bloquea si el pool está lleno)."""
+        evicted = None
+        with self._cond:
+            while True:
+                for i in range(len(self._idle) - 1, -1, -1):
+                    if self._idle[i][0] == key:
+                        self._leased += 1
+                        return self._idle.pop(i)[1]
+                if self._leased + len(self._idle) < self._max_size:
+                    break
+                if self._idle:
+                    _, evicted = self._idle.pop(0)
+                    break
+                self._cond.wait()
+            self._leased += 1
+        if evicted is not None:
+            logger.info("♻️ Cerrando cliente Stagehand ocioso de otra clave para liberar lugar...")
+            self._close_client(evicted)
+        try:
+            logger.info("🧩 Creando nuevo cliente Stagehand para el pool...")
+            return self._factory(*key)
+        except Exception:
+            with self._cond:
+                self._leased -= 1
+                self._cond.notify()
+            raise
+
+    def release(self, key, client, discard=False):
+        """Devuelve el cliente al pool, o lo cierra si quedó en mal estado."""
+        keep = not discard and getattr(client, "healthy", True)
+        with self._cond:
+            self._leased -= 1
+            if keep:
+                self._idle.append((key, client))
+            self._cond.notify()
+        if not keep:
+            self._close_client(client)
+
+    @contextmanager
+    def lease(self, key):
+        """Context manager: acquire + release, descartando el cliente si hubo una excepción."""
+        client = self.acquire(key)
+        try:
+            yield client
+        except Exception:
+            self.release(key, client, discard=True)
+            raise
+        else:
+            self.release(key, client)
+
+    def close_all(self):
+        """Cierra todos los clientes ociosos (se llama al apagar la aplicación)."""
+        with self._cond:
+            clients = [c for _, c in self._idle]
+            self._idle.clear()
+        for client in clients:
+            self._close_client(client)
+
+    @staticmethod
+    def _close_client(client):
+        try:
+            client.close()
+        except Exception as e:
+            logger.debug(f"⚠️ Error cerrando cliente Stagehand: {e}")